@@ -7,38 +7,61 @@ WHAT THIS IS NOT:
     consider a released block a 100% liability for the full 30 days)
 """
 
-import random
-import pandas as pd
+from collections import deque
 import numpy as np
 from typing import Tuple
 
+try:
+    from numba import njit
+except ImportError:  # numba is optional, without it the kernels below run as plain python
+    def njit(*args, **kwargs):
+        if args and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
 BUDGET_DAYS = 30  # denominator of the budget
 BUDGET_MONEY = 10000  # numerator of the budget
 AVG_TX_COUNT_PER_DAY = 1000  # Average number of blocked transactions per day
 MAX_TX_AMOUNT = 500  # The max send_amount we want to release
 DAYS_TO_SIMULATE = 90  # Number of days to simulate
+RANDOM_SEED = 0  # Seed of the simulation, None for a different simulation on every run
+
+_rng = np.random.default_rng(RANDOM_SEED)  # the one random generator every draw of the simulation comes from
+
 
+BLOCK_RATES = {'d1': .5, 'd2': .1, 'd3': .01, 'd4': .1}  # block rate of each simulated defense
+FLAG_BITS = {name: 1 << j for j, name in enumerate(BLOCK_RATES)}  # bit of each defense in the packed flags byte
+# One simulated transaction, see simulate_transactions
+TX_DTYPE = np.dtype([('flags', 'u1'), ('send_amount_usd', 'f8'), ('day', 'i4')])
 
-class Trasaction:
+
+def simulate_transactions(n: int, day: int) -> np.ndarray:
     """
-    Simulates a random flag_and_block transaction
+    Simulates n random flag_and_block transactions on the given day
 
-    d1 - d4 are simulations of four different defenses each with their own block rate
+    flags is a bitmask of d1 - d4, simulations of four different defenses each with their own block rate,
+          packed into one byte, see FLAG_BITS
     send_amount_usd is the simulated dollar amount randomly pulled from a triangle distrubition
                     meant to simulate SendWaves transaction shape
+    :param n: number of transactions to simulate
+    :param day: simulated date of the transactions
+    :return: TX_DTYPE array with one entry per transaction
     """
-
-    def __init__(self):
-        first = True
-        # We assume that every transaction that we look at in this simulation has been blocked for something
-        # Therefore we keep looping until at least one of the defenses is randomly assigned a block
-        while first or np.array([self.d1, self.d2, self.d3, self.d4]).sum().astype(bool) is False:
-            first = False
-            self.d1 = True if random.random() < .5 else False
-            self.d2 = True if random.random() < .1 else False
-            self.d3 = True if random.random() < .01 else False
-            self.d4 = True if random.random() < .1 else False
-        self.send_amount_usd = np.random.triangular(1, 100, 1000)
+    rates = np.array(list(BLOCK_RATES.values()))
+    blocks = _rng.random((n, rates.size)) < rates
+    flags = np.packbits(blocks, axis=1, bitorder='little').ravel()
+    # We assume that every transaction that we look at in this simulation has been blocked for something
+    # Therefore rows that no defense blocked are redrawn until at least one of the defenses is assigned a block
+    not_blocked = np.flatnonzero(flags == 0)
+    while not_blocked.size:
+        blocks[not_blocked] = _rng.random((not_blocked.size, rates.size)) < rates
+        flags[not_blocked] = np.packbits(blocks[not_blocked], axis=1, bitorder='little').ravel()
+        not_blocked = not_blocked[flags[not_blocked] == 0]
+    txs = np.empty(n, dtype=TX_DTYPE)
+    txs['flags'] = flags
+    txs['send_amount_usd'] = _rng.triangular(1, 100, 1000, size=n)
+    txs['day'] = day
+    return txs
 
 
 class Defense:
@@ -54,74 +77,117 @@ class Defense:
         self.name = name
         self.budget_money = budget_money
         self.budget_days = budget_days
+        self.bit = FLAG_BITS[name]  # bit of this defense in the flags of a transaction
+        # day and send_amount_usd of the historical transactions this defense blocked, in history order.
+        # The history is append only and chronological so _days stays sorted. Only the first _historical_count
+        # entries are filled, the storage doubles when it runs out so appending stays amortized O(new rows)
+        self._days = np.empty(0, dtype=np.int64)
+        self._amounts = np.empty(0, dtype=np.float64)
+        self._historical_count = 0  # number of historical transactions this defense blocked
+        self._daily_counts = np.zeros(0, dtype=np.int64)  # number of blocks on each day, indexed by day
+        # Running totals of the transactions blocked by this defense that Dead Reckoning released
+        self._released_amount = 0.0
+        self._released_count = 0
+
+    def mask(self, txs: np.ndarray) -> np.ndarray:
+        """
+        The transactions where this defense was positive, as a mask instead of a copy of those transactions.
+        Reductions over them run directly on the masked columns of txs
+        :param txs: TX_DTYPE array of transactions
+        :return: mask that is True for the transactions this defense blocked
+        """
+        return (txs['flags'] & self.bit) != 0
+
+    def update_day(self, new_tx: np.ndarray) -> None:
+        """
+        Register the transactions that were appended to the historical dataset
+        :param new_tx: rows appended to the historical dataset, in the same order
+        :return: None
+        """
+        mask = self.mask(new_tx)
+        days = new_tx['day'][mask]
+        start, end = self._historical_count, self._historical_count + days.size
+        if end > self._days.size:
+            # Out of storage, double it
+            self._days = np.resize(self._days, max(end, 2 * self._days.size))
+            self._amounts = np.resize(self._amounts, self._days.size)
+        self._days[start:end] = days
+        self._amounts[start:end] = new_tx['send_amount_usd'][mask]
+        self._historical_count = end
+        # bincount allocates at least as many days as are already counted, the running counts are folded into it
+        daily_counts = np.bincount(days, minlength=self._daily_counts.size)
+        daily_counts[:self._daily_counts.size] += self._daily_counts
+        self._daily_counts = daily_counts
+
+    def update_released(self, released_tx: np.ndarray) -> None:
+        """
+        Register the transactions that Dead Reckoning released
+        :param released_tx: newly released transactions
+        :return: None
+        """
+        mask = self.mask(released_tx)
+        self._released_amount += released_tx['send_amount_usd'].sum(where=mask)
+        self._released_count += np.count_nonzero(mask)
 
-    def average_historical_send_amount(self, h_tx: pd.DataFrame, day: int) -> float:
+    def average_historical_send_amount(self, day: int) -> float:
         """
         The average cost of a block release
-        :param h_tx: Historical dataset
         :param day: represent the chronological day in simulation history
         :return: mean send amount for transactions blocked by this defense
         """
-        defense_tx = self.defense_tx(h_tx)
-        return defense_tx[(defense_tx['day'] >= max(day - self.budget_days, 0)) &
-                          (defense_tx['send_amount_usd'] <= MAX_TX_AMOUNT)].send_amount_usd.mean()
+        # _days is sorted so the start of the budget window is found with a binary search
+        start = np.searchsorted(self._days[:self._historical_count], max(day - self.budget_days, 0))
+        window = self._amounts[start:self._historical_count]
+        return window[window <= MAX_TX_AMOUNT].mean()
 
-    def target_rate(self, h_tx: pd.DataFrame, day: int) -> int:
+    def target_rate(self, day: int) -> int:
         """
         The ideal number of blocks by this defense that we should release in 1 day
-        :param h_tx: Historical dataset
         :param day: represent the chronological day in simulation history
         :return: ideal releases per day
         """
-        rate = self.budget_money / (self.average_historical_send_amount(h_tx, day) * self.budget_days)
+        rate = self.budget_money / (self.average_historical_send_amount(day) * self.budget_days)
         # rate is multiplied by 10 to increase resolution when comparing
         # plus 1 is added to the rate to try and offset the effect of the budget never being allowed to be
         # larger than BUDGET_MONEY and therefore some example are lost
         return (rate * 10) + 1
 
-    def threshold(self, transaction: Trasaction, h_tx: pd.DataFrame, day: int) -> float:
+    def average_count_per_day(self) -> int:
         """
-        If this defense blocked this transaction then return:
-                    target rate -> a threshold value that should give us an approximatly optimum number of releases
-                                    per day
-        If this defense did not block this transaction then return:
-                    0 -> Within the scope of THIS DEFENSE we do not is any value in collecting this sample
-
-        :param transaction: Blocked transaction in question
-        :param h_tx: Historical dataset
-        :param day: represent the chronological day in simulation history
-        :return: threshold used to determine if block should be released or not
+        The average number of opportunities we have to release a block by this flag in a given day
+        :return: the average count of transactions per day where this defense was positive
         """
-        if getattr(transaction, self.name):
-            return self.target_rate(h_tx, day)
-        return 0.0
+        # Days without a block are not part of the average
+        return int(self._historical_count / np.count_nonzero(self._daily_counts))
 
-    def average_count_per_day(self, h_tx: pd.DataFrame) -> int:
+    def historical_count(self) -> int:
         """
-        The average number of opportunities we have to release a block by this flag in a given day
-        :param h_tx: Historical dataset
-        :return: the average count of transactions per day where this defense was positive
+        The number of opportunities we had to release a block by this flag over the whole history
+        :return: the number of historical transactions where this defense was positive
         """
-        defense_tx = h_tx.loc[h_tx[self.name] == True]
-        daily_counts = defense_tx.groupby('day').send_amount_usd.count()
-        return int(daily_counts.mean())
+        return self._historical_count
 
-    def random_value(self, h_tx: pd.DataFrame) -> int:
+    def released_amount(self) -> float:
         """
-        Get a random value from 0 to average-count-of-blocks-per-day for each defense
-        Note: the true average is multipled by ten to improve resolution
-        :param h_tx: Historical dataset
-        :return: random int
+        The liability Dead Reckoning took on by releasing blocks of this flag over the whole simulation
+        :return: sum of send_amount_usd of the released transactions where this defense was positive
         """
-        return random.randint(0, self.average_count_per_day(h_tx) * 10)
+        return self._released_amount
 
-    def defense_tx(self, h_tx: pd.DataFrame) -> pd.DataFrame:
+    def released_count(self) -> int:
         """
-        A subset of the historical dataset that contains only transactions where this defense was positive.
-        :param h_tx: Historical dataset
-        :return:
+        The number of blocks of this flag Dead Reckoning released over the whole simulation
+        :return: the number of released transactions where this defense was positive
         """
-        return h_tx.loc[h_tx[self.name] == True]
+        return self._released_count
+
+    def random_bound(self) -> int:
+        """
+        Random values for this defense are drawn from 0 to average-count-of-blocks-per-day
+        Note: the true average is multipled by ten to improve resolution
+        :return: exclusive upper bound of the random values
+        """
+        return self.average_count_per_day() * 10 + 1
 
 
 class Budget:
@@ -137,13 +203,17 @@ class Budget:
         self.budget_money = budget_money
         self.budget_days = budget_days
         self.defenses = []
+        self._allocated_money = 0.0  # running sum of budget_money over the registered defenses
+        # (day, send_amount_usd) of every released block still inside the budget window and their running sum
+        self.released_window = deque()
+        self.released_window_sum = 0.0
 
     def budget_allocation(self) -> Tuple[float, float]:
         """
         Return the percentage of the total budget allocated / not allocated
         :return: percent of budget claimed by registered defenses, percent of budget not claimed by register defenses
         """
-        total_allocated = np.array([d.budget_money for d in self.defenses]).sum() / self.budget_money
+        total_allocated = self._allocated_money / self.budget_money
         not_allocated = 1 - total_allocated
         return total_allocated, not_allocated
 
@@ -154,11 +224,15 @@ class Budget:
         :param allocation: relative weight of the budget that should be dedicated to samples of this defense
         :return: None
         """
-        if allocation + self.budget_allocation()[0] > 1:
+        if name not in FLAG_BITS:
+            raise Exception(f"Defense {name} is not simulated, supported defenses are {list(FLAG_BITS)}")
+        allocated = self.budget_allocation()[0]
+        if allocation + allocated > 1:
             raise Exception(f"This defenses budget of {allocation} plus the already allocated "
-                            f"budget of {self.budget_allocation()[0]} is greater than 1")
+                            f"budget of {allocated} is greater than 1")
 
         self.defenses.append(Defense(name, allocation * self.budget_money, self.budget_days))
+        self._allocated_money += allocation * self.budget_money
 
     def remove_defense(self, name: str) -> None:
         """
@@ -171,10 +245,34 @@ class Budget:
         for i, d in enumerate(self.defenses):
             if d.name != name:
                 temp.append(d)
+            else:
+                found = True
+                self._allocated_money -= d.budget_money
         if not found:
             print(f"Warning defense {name} not found")
         self.defenses = temp
 
+    def outstanding_liability(self, day: int) -> float:
+        """
+        Sum of released send amounts that still count against the budget on this day
+        :param day: simulated date of current tx
+        :return: outstanding liability in USD
+        """
+        cutoff = max(day - self.budget_days, 1)
+        while self.released_window and self.released_window[0][0] < cutoff:
+            self.released_window_sum -= self.released_window.popleft()[1]
+        return self.released_window_sum
+
+    def release(self, day: int, send_amount_usd: float) -> None:
+        """
+        Record a released block against the budget
+        :param day: simulated date of the released tx
+        :param send_amount_usd: send amount of the released tx
+        :return: None
+        """
+        self.released_window.append((day, send_amount_usd))
+        self.released_window_sum += send_amount_usd
+
 
 budget = Budget(BUDGET_MONEY, BUDGET_DAYS)
 budget.add_defense(name='d1', allocation=.1)
@@ -185,85 +283,100 @@ budget.add_defense(name='d4', allocation=.05)
 print(f"{budget.budget_allocation()[0]}% of the budget is allocated {budget.budget_allocation()[1]}% is not")
 
 
-def evaluate_if_released(tx, day, h_tx, r_tx):
-    """ The evaluation function returns if this block should be released or continue on as normal
-
-    :param tx: send_amount of transaction being evaluated
-    :param day: simulated date of current tx
-    :param h_tx: dataframe of all historical transactions
-    :param r_tx: datafrome of all transactions released by Dead Reckoning
-    :return: True or False if the tx should be released
+# The explicit signature compiles the kernel once at import and, with cache=True, numba stores the compiled code in
+# __pycache__ so later runs (e.g. sweeps over BUDGET_MONEY or the allocations) load it instead of compiling again
+@njit('Tuple((boolean[:], float64))(float64[:], int64[:], float64, float64)', cache=True)
+def _simulate_day(send_amounts, candidates, outstanding, budget_money):
+    """
+    Numeric core of the simulation, the budget check is the only sequential part of a day so it walks the
+    release candidates in order and releases them while they fit in the budget
+    :param send_amounts: send amount of every transaction
+    :param candidates: indices, in order, of the transactions that passed every other release check
+    :param outstanding: outstanding liability at the start of the day
+    :param budget_money: maximum outstanding liability
+    :return: mask of released transactions, outstanding liability at the end of the day
+    """
+    released = np.zeros(send_amounts.shape[0], dtype=np.bool_)
+    for i in candidates:
+        if outstanding + send_amounts[i] <= budget_money:
+            released[i] = True
+            outstanding += send_amounts[i]
+    return released, outstanding
+
+
+def evaluate_if_released(txs, thresholds, random_bounds, bits, outstanding, total_budget):
+    """ The evaluation function returns which blocks of the day should be released or continue on as normal
+
+    :param txs: simulated transactions of one day
+    :param thresholds: cutoff threshold (target rate) of each defense in the budget for this day
+    :param random_bounds: exclusive upper bound of the random values of each defense in the budget for this day
+    :param bits: flag bit of each defense in the budget
+    :param outstanding: outstanding liability at the start of the day
+    :param total_budget: the maximum dollar amount allowed to be spent
+    :return: mask that is True for the txs that should be released
     """
+    # Get a random value from 0 to average-count-of-blocks-per-day for each defense and transaction
+    random_values = _rng.integers(0, random_bounds, size=(txs.size, random_bounds.size))
 
-    # Get the cutoff threshold for each defense in the budget
-    thresholds = np.array([d.threshold(tx, h_tx, day) for d in budget.defenses])
+    # Pack the defenses whose random value is below their threshold into one byte per transaction,
+    # only the defenses that blocked the transaction (flags) count towards releasing it
+    passed = np.bitwise_or.reduce((random_values < thresholds) * bits, axis=1)
 
-    # Get a random value from 0 to average-count-of-blocks-per-day for each defense
-    random_values = np.array([d.random_value(h_tx) for d in budget.defenses])
+    # If the send_amount in USD is greater than our limit the block is not considered for release.
+    # If none of the random values issued by the defenses that blocked it is below the threshold for
+    # that same defense it is not considered for release.
+    candidates = np.flatnonzero((txs['send_amount_usd'] <= MAX_TX_AMOUNT) & ((txs['flags'] & passed) != 0))
 
-    # Get the maximum dollar amount allowed to be spent
-    total_budget = budget.budget_money
+    # The remaining candidates are released in order as long as releasing them does not put us over the total budget
+    # np.flatnonzero returns np.intp, which is not int64 on every platform, cast to match the kernel signature
+    released, _ = _simulate_day(txs['send_amount_usd'], candidates.astype(np.int64, copy=False),
+                                float(outstanding), float(total_budget))
+    for i in np.flatnonzero(released):
+        print(f"Transaction {txs['send_amount_usd'][i]} dollars was released --> "
+              f"Thresholds: {np.where(txs['flags'][i] & bits, thresholds, 0.0)} random_values: {random_values[i]}")
+    return released
 
-    # If the send_amount in USD is greater than our limit the block is not considered for release.
-    # If releasing this block would put us over the total budget it is not considered for release.
-    # If any one of the random values issued by all the defense in the budget is above the threshold for
-    # that same defense the block is released.
-    if tx.send_amount_usd <= MAX_TX_AMOUNT and r_tx[
-        r_tx['day'] >= max(day - BUDGET_DAYS, 1)].send_amount_usd.sum() + tx.send_amount_usd <= total_budget \
-            and (random_values < thresholds).sum().astype(bool):
-        print(f"Transaction {tx.send_amount_usd} dollars was released --> "
-              f"Thresholds: {thresholds} random_values: {random_values}")
-        return True
-    return False
-
-
-def print_results(released_tx: pd.DataFrame) -> None:
+
+def print_results(released_tx: np.ndarray) -> None:
     """
     Print the final results
-    :param released_tx:
+    :param released_tx: all transactions released by Dead Reckoning
     :return:
     """
+    # released_before[day] is the sum of everything released before that day, so the liability of any window
+    # of days is the difference of two entries
+    daily_released = np.bincount(released_tx['day'], weights=released_tx['send_amount_usd'])
+    released_before = np.concatenate([[0.0], np.cumsum(daily_released)])
     avg_outstanding_liability = 0
-    for day in range(released_tx.day.max() + 1):
-        outstanding_liability = released_tx[(released_tx['day'] >= max(day - BUDGET_DAYS, 1)) &
-                                            (released_tx['day'] < day)].send_amount_usd.sum()
+    for day in range(released_tx['day'].max() + 1):
+        outstanding_liability = released_before[day] - released_before[min(max(day - BUDGET_DAYS, 1), day)]
         print(f"day: {day}  {BUDGET_DAYS}-day budget result: {outstanding_liability}")
         if day > BUDGET_DAYS * 2:
             avg_outstanding_liability += outstanding_liability
     print(f"Average Outstanding Liability: {avg_outstanding_liability / (day - BUDGET_DAYS * 2)}")
 
 
-def print_progress(day: int, historical_tx: pd.DataFrame, released_tx: pd.DataFrame) -> None:
+def print_progress(day: int) -> None:
     """
     Print the in progress results
     :param day: simulated date of current tx
-    :param historical_tx: dataframe of all historical transactions
-    :param released_tx: datafrome of all transactions released by Dead Reckoning
     :return:
     """
-    print(f"Working on day {day - BUDGET_DAYS} consumed "
-          f"{released_tx[released_tx['day'] >= max(day - BUDGET_DAYS, 1)].send_amount_usd.sum()}")
+    print(f"Working on day {day - BUDGET_DAYS} consumed {budget.outstanding_liability(day)}")
     for d in budget.defenses:
-        print(f"{d.name}: {d.defense_tx(released_tx).send_amount_usd.sum()} "
-              f"release_count:  {d.defense_tx(released_tx).send_amount_usd.count()}   "
-              f"historical_count:  {d.defense_tx(historical_tx).send_amount_usd.count()}")
+        print(f"{d.name}: {d.released_amount()} "
+              f"release_count:  {d.released_count()}   "
+              f"historical_count:  {d.historical_count()}")
 
 
-def init_historical():
+def init_historical() -> np.ndarray:
     """
-    Build a history of transactions that can be used to calculate values like defense.threshold and
-    defense.random_value
-    :return: dataframe with simulated transactions
+    Build a history of transactions that can be used to calculate values like defense.target_rate and
+    defense.random_bound
+    :return: TX_DTYPE array with simulated transactions
     """
     print("Building Historical Dataset")
-    historical_tx = pd.DataFrame()
-    for day in range(1, BUDGET_DAYS + 1):
-        for i in range(AVG_TX_COUNT_PER_DAY):
-            tx = Trasaction()
-            record = tx.__dict__
-            record['day'] = day
-            historical_tx = historical_tx.append(pd.DataFrame(record, index=[0]), ignore_index=True)
-    return historical_tx
+    return np.concatenate([simulate_transactions(AVG_TX_COUNT_PER_DAY, day) for day in range(1, BUDGET_DAYS + 1)])
 
 
 def simulate() -> None:
@@ -272,19 +385,39 @@ def simulate() -> None:
     :return: None
     """
     historical_tx = init_historical()
-    released_tx = pd.DataFrame(columns=historical_tx.columns)  # collection of blocked transactions that were released
-    for day in range(historical_tx.day.max() + 1, DAYS_TO_SIMULATE):
-        print_progress(day, historical_tx, released_tx)
-        for i in range(AVG_TX_COUNT_PER_DAY):
-            tx = Trasaction()
-            record = tx.__dict__
-            record['day'] = day
-            if evaluate_if_released(tx, day, historical_tx, released_tx):
-                released_tx = released_tx.append(pd.DataFrame(record, index=[0]), ignore_index=True)
-            historical_tx = historical_tx.append(pd.DataFrame(record, index=[0]), ignore_index=True)
-    print(f"Released {len(released_tx)} Summing ${released_tx.send_amount_usd.sum()}")
+    # The defenses keep their own running statistics, so the full history and the released transactions are only
+    # needed for the final summary. Each simulated day is kept as its own array and they are all joined in one
+    # np.concatenate at the end
+    historical_days = [historical_tx]
+    released_days = [historical_tx[:0]]  # collection of blocked transactions that were released
+    # The budget does not change while simulating, look it up once instead of for every day
+    defenses = budget.defenses
+    bits = np.array([d.bit for d in defenses], dtype=np.uint8)
+    total_budget = budget.budget_money
+    for d in defenses:
+        d.update_day(historical_tx)
+    for day in range(historical_tx['day'].max() + 1, DAYS_TO_SIMULATE):
+        print_progress(day)
+        # The whole day is simulated as one batch
+        txs = simulate_transactions(AVG_TX_COUNT_PER_DAY, day)
+        # Per day values of every defense, constant for all the transactions of the day
+        thresholds = np.array([d.target_rate(day) for d in defenses])
+        random_bounds = np.array([d.random_bound() for d in defenses])
+        outstanding = budget.outstanding_liability(day)
+        released = evaluate_if_released(txs, thresholds, random_bounds, bits, outstanding, total_budget)
+        # The budget's rolling window is the one record of the outstanding liability
+        for send_amount_usd in txs['send_amount_usd'][released]:
+            budget.release(day, send_amount_usd)
+        released_days.append(txs[released])
+        historical_days.append(txs)
+        for d in defenses:
+            d.update_day(txs)
+            d.update_released(released_days[-1])
+    historical_tx = np.concatenate(historical_days)
+    released_tx = np.concatenate(released_days)
+    print(f"Released {len(released_tx)} Summing ${released_tx['send_amount_usd'].sum()}")
     print_results(released_tx)
-    print(f"Simulated {len(historical_tx)} transactions totaling ${historical_tx.send_amount_usd.sum()}")
+    print(f"Simulated {len(historical_tx)} transactions totaling ${historical_tx['send_amount_usd'].sum()}")
 
 
 if __name__ == '__main__':